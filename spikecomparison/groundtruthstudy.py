@@ -1,8 +1,11 @@
 from pathlib import Path
+from collections import defaultdict
 import os
+import pickle
 
 import numpy as np
 import pandas as pd
+from joblib import Parallel, delayed
 
 import spikeextractors as se
 
@@ -13,18 +16,74 @@ from .studytools import (setup_comparison_study, run_study_sorters, get_rec_name
                          get_one_recording, copy_sortings_to_npz, iter_computed_names,
                          iter_computed_sorting, collect_run_times)
 
-import spiketoolkit as st
+
+def _load_npz_spiketrains(filename):
+    """
+    Read a file written by NpzSortingExtractor.write_sorting() into a dict {unit_id: spike_train}.
+
+    Spikes are grouped by unit with one stable argsort on labels so each unit is a
+    contiguous slice (located with searchsorted) of the same sorted vector.
+    Note that npz archives can not be memory mapped, arrays are read once here.
+    """
+    with np.load(str(filename)) as npz:
+        unit_ids = npz['unit_ids']
+        spike_indexes = npz['spike_indexes']
+        spike_labels = npz['spike_labels']
+        sampling_frequency = None
+        if 'sampling_frequency' in npz.files:
+            try:
+                sampling_frequency = float(npz['sampling_frequency'])
+            except ValueError:
+                # a None sampling_frequency is stored as an object array, it is not unpickled
+                sampling_frequency = None
+
+    order = np.argsort(spike_labels, kind='stable')
+    spike_indexes = spike_indexes[order]
+    spike_labels = spike_labels[order]
+    starts = np.searchsorted(spike_labels, unit_ids, side='left')
+    stops = np.searchsorted(spike_labels, unit_ids, side='right')
+    spiketrains = {unit_id: spike_indexes[start:stop]
+                   for unit_id, start, stop in zip(unit_ids.tolist(), starts, stops)}
+
+    return spiketrains, sampling_frequency
+
+
+def _prepare_spiketrains(sorting):
+    """
+    Extract all spike trains of a sorting once, as int64 arrays.
+    """
+    return {unit_id: np.asarray(sorting.get_unit_spike_train(unit_id), dtype='int64')
+            for unit_id in sorting.get_unit_ids()}
+
+
+def _sorting_from_spiketrains(spiketrains, sampling_frequency):
+    """
+    In memory sorting: get_unit_spike_train() only touches the spikes of one unit.
+    """
+    sorting = se.NumpySortingExtractor()
+    for unit_id, spike_train in spiketrains.items():
+        sorting.add_unit(unit_id, spike_train)
+    if sampling_frequency is not None:
+        sorting.set_sampling_frequency(sampling_frequency)
+    return sorting
 
 
 class GroundTruthStudy:
-    def __init__(self, study_folder=None):
+    def __init__(self, study_folder=None, cache_sortings=True):
         self.study_folder = Path(study_folder)
-        self._is_scanned = False
-        self.computed_names = None
-        self.rec_names = None
-        self.sorter_names = None
+        self.cache_sortings = cache_sortings
+        self._sortings_cache = None
+        self._sortings_mtime = None
+        self._gt_cache = {}
+        self._snr_cache = {}
 
-        self.scan_folder()
+        # folder is scanned lazily on first access to rec_names/sorter_names/computed_names
+        self._is_scanned = False
+        self._computed_names = None
+        self._rec_names = None
+        self._rec_name_set = None
+        self._sorter_names = None
+        self._sorter_name_set = None
 
         self.comparisons = None
         self.exhaustive_gt = None
@@ -39,37 +98,110 @@ class GroundTruthStudy:
         return t
 
     def scan_folder(self):
-        self.rec_names = get_rec_names(self.study_folder)
+        self._rec_names = get_rec_names(self.study_folder)
+        self._rec_name_set = set(self._rec_names)
         # scan computed names
-        self.computed_names = list(iter_computed_names(self.study_folder))  # list of pair (rec_name, sorter_name)
-        self.sorter_names = np.unique([e for _, e in iter_computed_names(self.study_folder)]).tolist()
+        self._computed_names = list(iter_computed_names(self.study_folder))  # list of pair (rec_name, sorter_name)
+        self._sorter_name_set = {sorter_name for _, sorter_name in self._computed_names}
+        self._sorter_names = sorted(self._sorter_name_set)
+        self._gt_cache = {}
+        self._sortings_cache = None
+        self._sortings_mtime = None
         self._is_scanned = True
 
+    @property
+    def rec_names(self):
+        if not self._is_scanned:
+            self.scan_folder()
+        return self._rec_names
+
+    @property
+    def computed_names(self):
+        if not self._is_scanned:
+            self.scan_folder()
+        return self._computed_names
+
+    @property
+    def sorter_names(self):
+        if not self._is_scanned:
+            self.scan_folder()
+        return self._sorter_names
+
     @classmethod
     def create(cls, study_folder, gt_dict):
         setup_comparison_study(study_folder, gt_dict)
         return cls(study_folder)
 
+    def _iter_sortings(self):
+        """
+        Iterate over (rec_name, sorter_name, sorting).
+
+        With cache_sortings=True the sortings are loaded from disk only once
+        and then kept in memory until the next scan_folder().
+        """
+        # the first (lazy) scan resets the caches, so it must happen before filling them
+        if not self._is_scanned:
+            self.scan_folder()
+        if not self.cache_sortings:
+            return iter_computed_sorting(self.study_folder)
+        if self._sortings_cache is None:
+            self._sortings_mtime = self._stat_sortings()
+            self._sortings_cache = list(iter_computed_sorting(self.study_folder))
+        return self._sortings_cache
+
+    def _stat_sortings(self):
+        """
+        mtime of each sorting npz, {(rec_name, sorter_name): mtime}.
+        """
+        return {(rec_name, sorter_name): os.path.getmtime(self._sorting_filename(rec_name, sorter_name))
+                for rec_name, sorter_name in iter_computed_names(self.study_folder)}
+
+    def _sorting_filename(self, rec_name, sorter_name):
+        return self.study_folder / 'sortings' / (rec_name + '[#]' + sorter_name + '.npz')
+
+    def _sortings_by_rec(self):
+        """
+        Group (sorter_name, sorting) by rec_name so that what only depends
+        on the recording (ground truth, ...) is loaded once per group.
+        """
+        by_rec = defaultdict(list)
+        for rec_name, sorter_name, sorting in self._iter_sortings():
+            by_rec[rec_name].append((sorter_name, sorting))
+        return by_rec
+
     def run_sorters(self, sorter_list, sorter_params={}, mode='keep',
                     engine='loop', engine_kargs={}, verbose=False):
         run_study_sorters(self.study_folder, sorter_list, sorter_params=sorter_params,
                           engine=engine, engine_kargs=engine_kargs, verbose=verbose)
+        # new sortings are on disk: refresh names and drop cached sortings
+        self.scan_folder()
 
     def _check_rec_name(self, rec_name):
         if not self._is_scanned:
             self.scan_folder()
-        if len(self.rec_names) > 1 and rec_name is None:
+        if rec_name is None:
+            if len(self._rec_names) == 1:
+                return self._rec_names[0]
             raise Exception("Pass 'rec_name' parameter to select which recording to use.")
-        elif len(self.rec_names) == 1:
-            rec_name = self.rec_names[0]
-        else:
-            rec_name = self.rec_names[self.rec_names.index(rec_name)]
+        if rec_name not in self._rec_name_set:
+            raise KeyError("'{}' is not a recording of this study".format(rec_name))
         return rec_name
 
     def get_ground_truth(self, rec_name=None):
+        """
+        Get the ground truth sorting of a recording.
+
+        This is an in memory NumpySortingExtractor (not a NpzSortingExtractor).
+        The npz file is read only once per rec_name, each call returns a new
+        extractor wrapping the cached spike trains, so properties set on it
+        are not shared.
+        """
         rec_name = self._check_rec_name(rec_name)
-        sorting = se.NpzSortingExtractor(self.study_folder / 'ground_truth' / (rec_name + '.npz'))
-        return sorting
+        if rec_name not in self._gt_cache:
+            self._gt_cache[rec_name] = _load_npz_spiketrains(self.study_folder / 'ground_truth' /
+                                                             (rec_name + '.npz'))
+        spiketrains, sampling_frequency = self._gt_cache[rec_name]
+        return _sorting_from_spiketrains(spiketrains, sampling_frequency)
 
     def get_recording(self, rec_name=None):
         rec_name = self._check_rec_name(rec_name)
@@ -80,8 +212,8 @@ class GroundTruthStudy:
         rec_name = self._check_rec_name(rec_name)
 
         selected_sorting = None
-        if sort_name in self.sorter_names:
-            for r_name, sorter_name, sorting in iter_computed_sorting(self.study_folder):
+        if sort_name in self._sorter_name_set:
+            for r_name, sorter_name, sorting in self._iter_sortings():
                 if sort_name == sorter_name and r_name == rec_name:
                     selected_sorting = sorting
         return selected_sorting
@@ -90,84 +222,202 @@ class GroundTruthStudy:
         copy_sortings_to_npz(self.study_folder)
         self.scan_folder()
 
-    def run_comparisons(self, exhaustive_gt=False, **kwargs):
+    def _comparison_cache_key(self, rec_name, sorting_mtime, exhaustive_gt, kwargs):
+        gt_filename = self.study_folder / 'ground_truth' / (rec_name + '.npz')
+        # n_jobs does not change the result so it is not part of the key
+        params = tuple(sorted((k, v) for k, v in kwargs.items() if k != 'n_jobs'))
+        return (os.path.getmtime(gt_filename), sorting_mtime, params, exhaustive_gt)
+
+    @staticmethod
+    def _load_cached_comparison(filename, key):
+        """
+        Return the pickled comparison if it matches key, None otherwise.
+        An unreadable or incompatible file is treated as a cache miss.
+        """
+        try:
+            with open(filename, mode='rb') as f:
+                cached = pickle.load(f)
+            if cached['key'] == key:
+                return cached['comparison']
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, KeyError, TypeError, ValueError):
+            # ValueError: e.g. 'unsupported pickle protocol' for a file written by a newer python
+            pass
+        return None
+
+    def run_comparisons(self, exhaustive_gt=False, n_jobs_comparisons=1, force_recompute=False,
+                        cache_comparisons=True, **kwargs):
+        """
+        Run all ground truth comparisons.
+
+        With cache_comparisons=True, comparisons are pickled into the 'comparisons' subfolder
+        and reloaded on the next call as long as the GT and sorting npz files and the
+        parameters did not change. Note that these pickles contain the full GT and tested
+        spike trains. Use force_recompute=True to ignore (and rewrite) this cache, and
+        cache_comparisons=False to neither read nor write it.
+
+        n_jobs_comparisons controls how many comparisons run in parallel with joblib.
+        As before, n_jobs in kwargs is given to each comparison (spike matching). When
+        n_jobs_comparisons != 1 and n_jobs is not given, comparisons use n_jobs=1 to
+        avoid oversubscription.
+        """
+        comparisons_folder = self.study_folder / 'comparisons'
+        if cache_comparisons:
+            comparisons_folder.mkdir(parents=True, exist_ok=True)
+
+        # the key uses the sorting mtime from before the file was read, so that a sorting
+        # rewritten on disk after being loaded (and cached) never matches its new mtime
+        if self.cache_sortings:
+            by_rec = self._sortings_by_rec()
+            sortings_mtime = self._sortings_mtime
+        else:
+            sortings_mtime = self._stat_sortings()
+            by_rec = self._sortings_by_rec()
+
         self.comparisons = {}
-        for rec_name, sorter_name, sorting in iter_computed_sorting(self.study_folder):
-            gt_sorting = self.get_ground_truth(rec_name)
-            sc = compare_sorter_to_ground_truth(gt_sorting, sorting, exhaustive_gt=exhaustive_gt, **kwargs)
+        to_compute = []
+        for rec_name, pairs in by_rec.items():
+            gt_sorting = None
+            for sorter_name, sorting in pairs:
+                sorting_mtime = sortings_mtime.get((rec_name, sorter_name))
+                # a sorting that appeared after the stat is not cached
+                use_cache = cache_comparisons and sorting_mtime is not None
+                key = self._comparison_cache_key(rec_name, sorting_mtime, exhaustive_gt, kwargs)
+                filename = comparisons_folder / (rec_name + '[#]' + sorter_name + '.pkl')
+                if use_cache and not force_recompute and os.path.exists(filename):
+                    sc = self._load_cached_comparison(filename, key)
+                    if sc is not None:
+                        self.comparisons[(rec_name, sorter_name)] = sc
+                        continue
+                if gt_sorting is None:
+                    gt_sorting = self.get_ground_truth(rec_name)
+                # spike trains are extracted once so the comparison does not hit the npz extractor in its loops
+                sorting = _sorting_from_spiketrains(_prepare_spiketrains(sorting), sorting.get_sampling_frequency())
+                to_compute.append((rec_name, sorter_name, gt_sorting, sorting, key if use_cache else None, filename))
+
+        if n_jobs_comparisons != 1 and 'n_jobs' not in kwargs:
+            kwargs = dict(kwargs, n_jobs=1)
+        results = Parallel(n_jobs=n_jobs_comparisons)(
+            delayed(compare_sorter_to_ground_truth)(gt_sorting, sorting, exhaustive_gt=exhaustive_gt, **kwargs)
+            for _, _, gt_sorting, sorting, _, _ in to_compute)
+
+        for (rec_name, sorter_name, _, _, key, filename), sc in zip(to_compute, results):
+            if key is not None:
+                with open(filename, mode='wb') as f:
+                    pickle.dump({'key': key, 'comparison': sc}, f)
             self.comparisons[(rec_name, sorter_name)] = sc
         self.exhaustive_gt = exhaustive_gt
 
     def aggregate_run_times(self):
         return collect_run_times(self.study_folder)
 
-    def aggregate_performance_by_units(self):
+    def _aggregate_all(self, well_detected_score=None, redundant_score=None, overmerged_score=None,
+                       return_indexed=True, with_perf=True, with_count=True):
+        """
+        Loop only once over all sortings to build perf_by_units and/or count_units.
+        A table that is not asked for (with_perf/with_count) is returned as None.
+
+        With return_indexed=False both tables are returned flat (keys as first columns)
+        so they can be written out without a set_index/reset_index round trip.
+        """
         assert self.comparisons is not None, 'run_comparisons first'
 
         perf_by_units = []
-        for rec_name, sorter_name, sorting in iter_computed_sorting(self.study_folder):
-            comp = self.comparisons[(rec_name, sorter_name)]
 
-            perf = comp.get_performance(method='by_unit', output='pandas')
-            perf['rec_name'] = rec_name
-            perf['sorter_name'] = sorter_name
-            perf = perf.reset_index()
-            perf_by_units.append(perf)
+        # count_units is collected as one record per sorting and the DataFrame is built once at the end
+        count_keys = ['rec_name', 'sorter_name', 'num_gt', 'num_sorter', 'num_well_detected', 'num_redundant',
+                      'num_overmerged']
+        if self.exhaustive_gt:
+            count_keys += ['num_false_positive', 'num_bad']
+        count_rows = []
+
+        for rec_name, pairs in self._sortings_by_rec().items():
+            for sorter_name, sorting in pairs:
+                comp = self.comparisons[(rec_name, sorter_name)]
+
+                if with_perf:
+                    perf = comp.get_performance(method='by_unit', output='pandas')
+                    perf = perf.reset_index()
+                    perf.insert(0, 'sorter_name', sorter_name)
+                    perf.insert(0, 'rec_name', rec_name)
+                    perf_by_units.append(perf)
+
+                if with_count:
+                    row = {
+                        'rec_name': rec_name,
+                        'sorter_name': sorter_name,
+                        # the GT is already held by the comparison, no need to load it again
+                        'num_gt': len(comp.sorting1.get_unit_ids()),
+                        'num_sorter': len(sorting.get_unit_ids()),
+                        'num_well_detected': comp.count_well_detected_units(well_detected_score),
+                        'num_redundant': comp.count_redundant_units(redundant_score),
+                        'num_overmerged': comp.count_overmerged_units(overmerged_score),
+                    }
+                    if self.exhaustive_gt:
+                        row['num_false_positive'] = comp.count_false_positive_units(redundant_score)
+                        row['num_bad'] = comp.count_bad_units()
+                    count_rows.append(row)
+
+        count_units = None
+        if with_count:
+            count_units = pd.DataFrame.from_records(count_rows, columns=count_keys)
+            if return_indexed:
+                count_units = count_units.set_index(['rec_name', 'sorter_name'])
+
+        if with_perf:
+            perf_by_units = pd.concat(perf_by_units, ignore_index=True)
+            if return_indexed:
+                perf_by_units = perf_by_units.set_index(['rec_name', 'sorter_name', 'gt_unit_id'])
+        else:
+            perf_by_units = None
 
-        perf_by_units = pd.concat(perf_by_units)
-        perf_by_units = perf_by_units.set_index(['rec_name', 'sorter_name', 'gt_unit_id'])
+        return perf_by_units, count_units
 
+    def aggregate_performance_by_units(self, return_indexed=True):
+        perf_by_units, _ = self._aggregate_all(return_indexed=return_indexed, with_count=False)
         return perf_by_units
 
     def aggregate_count_units(self, well_detected_score=None, redundant_score=None, overmerged_score=None):
-        assert self.comparisons is not None, 'run_comparisons first'
-
-        index = pd.MultiIndex.from_tuples(self.computed_names, names=['rec_name', 'sorter_name'])
-
-        count_units = pd.DataFrame(index=index, columns=['num_gt', 'num_sorter', 'num_well_detected', 'num_redundant',
-                                                         'num_overmerged'])
+        _, count_units = self._aggregate_all(well_detected_score=well_detected_score,
+                                             redundant_score=redundant_score, overmerged_score=overmerged_score,
+                                             with_perf=False)
+        return count_units
 
-        if self.exhaustive_gt:
-            count_units['num_false_positive'] = None
-            count_units['num_bad'] = None
-
-        for rec_name, sorter_name, sorting in iter_computed_sorting(self.study_folder):
-            gt_sorting = self.get_ground_truth(rec_name)
-            comp = self.comparisons[(rec_name, sorter_name)]
-
-            count_units.loc[(rec_name, sorter_name), 'num_gt'] = len(gt_sorting.get_unit_ids())
-            count_units.loc[(rec_name, sorter_name), 'num_sorter'] = len(sorting.get_unit_ids())
-            count_units.loc[(rec_name, sorter_name), 'num_well_detected'] = \
-                comp.count_well_detected_units(well_detected_score)
-            count_units.loc[(rec_name, sorter_name), 'num_redundant'] = comp.count_redundant_units(redundant_score)
-            count_units.loc[(rec_name, sorter_name), 'num_overmerged'] = comp.count_overmerged_units(overmerged_score)
-            if self.exhaustive_gt:
-                count_units.loc[(rec_name, sorter_name), 'num_false_positive'] = \
-                    comp.count_false_positive_units(redundant_score)
-                count_units.loc[(rec_name, sorter_name), 'num_bad'] = comp.count_bad_units()
+    def aggregate_dataframes(self, copy_into_folder=True, table_format='csv', **karg_thresh):
+        """
+        Aggregate run_times, perf_by_units and count_units tables.
 
-        return count_units
+        With copy_into_folder=True tables are also written into the 'tables' subfolder,
+        either as tab separated 'csv' or as 'parquet' (needs pyarrow). Parquet files are
+        smaller, faster to write and read back, and keep dtypes.
+        """
+        if table_format not in ('csv', 'parquet'):
+            raise ValueError("table_format must be 'csv' or 'parquet', not {!r}".format(table_format))
 
-    def aggregate_dataframes(self, copy_into_folder=True, **karg_thresh):
         dataframes = {}
         dataframes['run_times'] = self.aggregate_run_times().reset_index()
-        perfs = self.aggregate_performance_by_units()
+        perfs, count_units = self._aggregate_all(return_indexed=False, **karg_thresh)
 
-        dataframes['perf_by_units'] = perfs.reset_index()
+        dataframes['perf_by_units'] = perfs
         # dataframes['perf_pooled_with_average'] = perfs.reset_index().groupby(['rec_name', 'sorter_name']).mean().reset_index()
-        dataframes['count_units'] = self.aggregate_count_units(**karg_thresh).reset_index()
+        dataframes['count_units'] = count_units
 
         if copy_into_folder:
             tables_folder = self.study_folder / 'tables'
-            if not os.path.exists(tables_folder):
-                os.makedirs(str(tables_folder))
+            tables_folder.mkdir(parents=True, exist_ok=True)
 
             for name, df in dataframes.items():
-                df.to_csv(str(tables_folder / (name + '.csv')), sep='\t', index=False)
+                if table_format == 'csv':
+                    df.to_csv(tables_folder / (name + '.csv'), sep='\t', index=False, chunksize=100000)
+                elif table_format == 'parquet':
+                    df.to_parquet(tables_folder / (name + '.parquet'), engine='pyarrow', compression='zstd',
+                                  index=False)
 
         return dataframes
 
     def _compute_snr(self, rec_name, **snr_kargs):
+        # spiketoolkit is heavy to import and only needed here
+        import spiketoolkit as st
+
         #  print('compute SNR', rec_name)
         rec = self.get_recording(rec_name)
         gt_sorting = self.get_ground_truth(rec_name)
@@ -183,12 +433,14 @@ class GroundTruthStudy:
     def get_units_snr(self, rec_name=None):
         """
         Load or compute units SNR for a given recording.
+        The result is also kept in memory, a copy is returned.
         """
         rec_name = self._check_rec_name(rec_name)
+        if rec_name in self._snr_cache:
+            return self._snr_cache[rec_name].copy()
 
         metrics_folder = self.study_folder / 'metrics'
-        if not (os.path.exists(metrics_folder)):
-            os.makedirs(str(metrics_folder))
+        metrics_folder.mkdir(parents=True, exist_ok=True)
         filename = metrics_folder / ('SNR ' + rec_name + '.txt')
 
         if os.path.exists(filename):
@@ -197,5 +449,6 @@ class GroundTruthStudy:
         else:
             snr = self._compute_snr(rec_name)
             snr.reset_index().to_csv(filename, sep='\t', index=False)
+        self._snr_cache[rec_name] = snr
 
-        return snr
+        return snr.copy()
@@ -10,6 +10,7 @@ into a "study_folder" with several subfolder:
   * ground_truth : contains a copy of sorting ground  in npz format
   * sortings: contains light copy of all sorting in npz format
   * tables: some table in cvs format
+  * comparisons: pickled GroundTruthComparison cache used by GroundTruthStudy
 """
 
 from pathlib import Path
@@ -250,10 +251,13 @@ def copy_sortings_to_npz(study_folder):
 
 def iter_computed_names(study_folder):
     sorting_folder = Path(study_folder) / 'sortings'
-    for filename in os.listdir(sorting_folder):
-        if filename.endswith('.npz') and '[#]' in filename:
-            rec_name, sorter_name = filename.replace('.npz', '').split('[#]')
-            yield rec_name, sorter_name
+    # scandir gives file type from the directory read itself (no extra stat per entry)
+    with os.scandir(sorting_folder) as it:
+        for entry in it:
+            filename = entry.name
+            if entry.is_file() and filename.endswith('.npz') and '[#]' in filename:
+                rec_name, sorter_name = filename.replace('.npz', '').split('[#]')
+                yield rec_name, sorter_name
 
 
 def iter_computed_sorting(study_folder):
@@ -261,11 +265,13 @@ def iter_computed_sorting(study_folder):
     Iter over sorting files.
     """
     sorting_folder = Path(study_folder) / 'sortings'
-    for filename in os.listdir(sorting_folder):
-        if filename.endswith('.npz') and '[#]' in filename:
-            rec_name, sorter_name = filename.replace('.npz', '').split('[#]')
-            sorting = se.NpzSortingExtractor(sorting_folder / filename)
-            yield rec_name, sorter_name, sorting
+    with os.scandir(sorting_folder) as it:
+        for entry in it:
+            filename = entry.name
+            if entry.is_file() and filename.endswith('.npz') and '[#]' in filename:
+                rec_name, sorter_name = filename.replace('.npz', '').split('[#]')
+                sorting = se.NpzSortingExtractor(sorting_folder / filename)
+                yield rec_name, sorter_name, sorting
 
 
 def collect_run_times(study_folder):
@@ -279,8 +285,7 @@ def collect_run_times(study_folder):
     log_folder = sorting_folders / 'run_log'
     tables_folder = study_folder / 'tables'
 
-    if not os.path.exists(tables_folder):
-        os.makedirs(str(tables_folder))
+    tables_folder.mkdir(parents=True, exist_ok=True)
 
     run_times = []
     for filename in os.listdir(log_folder):
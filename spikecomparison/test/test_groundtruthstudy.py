@@ -2,12 +2,16 @@ import os
 import shutil
 import time
 import pickle
+from pathlib import Path
 
 import pytest
+import numpy as np
+import pandas as pd
 
 import spikeextractors as se
 
-from spikecomparison.groundtruthstudy import GroundTruthStudy
+import spikecomparison.groundtruthstudy
+from spikecomparison.groundtruthstudy import GroundTruthStudy, _load_npz_spiketrains
 
 study_folder = 'test_groundtruthstudy/'
 
@@ -58,6 +62,259 @@ def test_extract_sortings():
     dataframes = study.aggregate_dataframes()
 
 
+def test_load_npz_spiketrains(tmp_path):
+
+    sorting = se.NumpySortingExtractor()
+    sorting.add_unit(0, np.array([5, 20, 100], dtype='int64'))
+    sorting.add_unit(3, np.array([], dtype='int64'))
+    sorting.add_unit(7, np.array([1, 50], dtype='int64'))
+    sorting.set_sampling_frequency(30000.)
+    filename = str(tmp_path / 'loader.npz')
+    se.NpzSortingExtractor.write_sorting(sorting, filename)
+
+    spiketrains, sampling_frequency = _load_npz_spiketrains(filename)
+    npz_sorting = se.NpzSortingExtractor(filename)
+    assert list(spiketrains.keys()) == list(npz_sorting.get_unit_ids())
+    for unit_id in npz_sorting.get_unit_ids():
+        assert np.array_equal(spiketrains[unit_id], npz_sorting.get_unit_spike_train(unit_id))
+    assert spiketrains[3].size == 0
+    assert sampling_frequency == npz_sorting.get_sampling_frequency()
+
+    # old files can miss sampling_frequency
+    filename = str(tmp_path / 'loader_no_sf.npz')
+    np.savez(filename, unit_ids=np.array([0, 1]), spike_indexes=np.array([2, 3, 8]),
+             spike_labels=np.array([1, 0, 1]))
+    spiketrains, sampling_frequency = _load_npz_spiketrains(filename)
+    assert sampling_frequency is None
+    assert np.array_equal(spiketrains[0], [3])
+    assert np.array_equal(spiketrains[1], [2, 8])
+
+
+def _make_sorting(spiketrains, sampling_frequency=30000.):
+    sorting = se.NumpySortingExtractor()
+    for unit_id, spike_train in spiketrains.items():
+        sorting.add_unit(unit_id, np.asarray(spike_train, dtype='int64'))
+    sorting.set_sampling_frequency(sampling_frequency)
+    return sorting
+
+
+def _setup_synthetic_study(folder, rec_names=('rec0', 'rec1'), sorter_names=('sorterA', 'sorterB')):
+    """
+    Study folder with npz sortings only (no recording, no sorter run).
+    """
+    folder = Path(folder)
+    (folder / 'ground_truth').mkdir(parents=True)
+    (folder / 'sortings' / 'run_log').mkdir(parents=True)
+
+    with open(folder / 'names.txt', mode='w', encoding='utf8') as f:
+        for rec_name in rec_names:
+            f.write(rec_name + '\n')
+
+    rng = np.random.RandomState(0)
+    for rec_name in rec_names:
+        gt_trains = {u: np.sort(rng.choice(300000, size=200, replace=False)) for u in range(5)}
+        se.NpzSortingExtractor.write_sorting(_make_sorting(gt_trains), folder / 'ground_truth' / (rec_name + '.npz'))
+        for s, sorter_name in enumerate(sorter_names):
+            # some well detected units, one missed unit and one noise unit
+            trains = {u + 10: gt_trains[u][rng.rand(200) > 0.1 * s] + 2 for u in range(4)}
+            trains[20] = np.sort(rng.choice(300000, size=100, replace=False))
+            fname = rec_name + '[#]' + sorter_name
+            se.NpzSortingExtractor.write_sorting(_make_sorting(trains), folder / 'sortings' / (fname + '.npz'))
+            with open(folder / 'sortings' / 'run_log' / (fname + '.txt'), mode='w') as f:
+                f.write('run_time: 1.5\n')
+
+    return folder
+
+
+def _count_comparisons(monkeypatch):
+    calls = []
+    compare = spikecomparison.groundtruthstudy.compare_sorter_to_ground_truth
+
+    def counting_compare(*args, **kwargs):
+        calls.append(1)
+        return compare(*args, **kwargs)
+
+    monkeypatch.setattr(spikecomparison.groundtruthstudy, 'compare_sorter_to_ground_truth', counting_compare)
+    return calls
+
+
+def test_comparisons_disk_cache(tmp_path, monkeypatch):
+    folder = _setup_synthetic_study(tmp_path / 'cache_study')
+    calls = _count_comparisons(monkeypatch)
+
+    study = GroundTruthStudy(folder)
+    study.run_comparisons(exhaustive_gt=True)
+    assert len(calls) == 4
+    perf = study.aggregate_performance_by_units()
+
+    # hit
+    study = GroundTruthStudy(folder)
+    study.run_comparisons(exhaustive_gt=True)
+    assert len(calls) == 4
+    assert perf.equals(study.aggregate_performance_by_units())
+
+    # n_jobs is not part of the key
+    study.run_comparisons(exhaustive_gt=True, n_jobs=1)
+    assert len(calls) == 4
+
+    # miss on changed kwargs
+    study.run_comparisons(exhaustive_gt=True, delta_time=0.3)
+    assert len(calls) == 8
+
+    # a sorting changed on disk after being cached in memory is not stored under its new mtime
+    sorting_filename = folder / 'sortings' / 'rec0[#]sorterA.npz'
+    mtime = os.path.getmtime(sorting_filename)
+    os.utime(str(sorting_filename), (mtime + 10, mtime + 10))
+    study.run_comparisons(exhaustive_gt=True, delta_time=0.3)
+    assert len(calls) == 8
+
+    # miss on changed mtime once the folder is rescanned (or in a new session)
+    study.scan_folder()
+    study.run_comparisons(exhaustive_gt=True, delta_time=0.3)
+    assert len(calls) == 9
+    study = GroundTruthStudy(folder)
+    study.run_comparisons(exhaustive_gt=True, delta_time=0.3)
+    assert len(calls) == 9
+
+    # force_recompute
+    study.run_comparisons(exhaustive_gt=True, delta_time=0.3, force_recompute=True)
+    assert len(calls) == 13
+
+    # corrupt file is recomputed and rewritten
+    with open(folder / 'comparisons' / 'rec1[#]sorterB.pkl', mode='wb') as f:
+        f.write(b'not a pickle')
+    study.run_comparisons(exhaustive_gt=True, delta_time=0.3)
+    assert len(calls) == 14
+    study.run_comparisons(exhaustive_gt=True, delta_time=0.3)
+    assert len(calls) == 14
+
+    # pickle protocol unknown to this python (ValueError) is also a miss
+    with open(folder / 'comparisons' / 'rec1[#]sorterB.pkl', mode='wb') as f:
+        f.write(b'\x80\xff')
+    study.run_comparisons(exhaustive_gt=True, delta_time=0.3)
+    assert len(calls) == 15
+
+    # no cache at all
+    shutil.rmtree(str(folder / 'comparisons'))
+    study.run_comparisons(exhaustive_gt=True, cache_comparisons=False)
+    assert len(calls) == 19
+    assert not (folder / 'comparisons').exists()
+
+
+def test_check_rec_name(tmp_path):
+    study = GroundTruthStudy(_setup_synthetic_study(tmp_path / 'two_rec_study'))
+    assert study._check_rec_name('rec1') == 'rec1'
+    with pytest.raises(KeyError):
+        study._check_rec_name('not_a_rec')
+    with pytest.raises(Exception):
+        study._check_rec_name(None)
+
+    study = GroundTruthStudy(_setup_synthetic_study(tmp_path / 'one_rec_study', rec_names=('rec0',)))
+    assert study._check_rec_name(None) == 'rec0'
+    assert study._check_rec_name('rec0') == 'rec0'
+    # a wrong name is not silently replaced by the only recording
+    with pytest.raises(KeyError):
+        study._check_rec_name('not_a_rec')
+
+
+def test_aggregate_dataframes_bad_format(tmp_path):
+    study = GroundTruthStudy(_setup_synthetic_study(tmp_path / 'bad_format_study'))
+    study.run_comparisons(exhaustive_gt=True, cache_comparisons=False)
+    with pytest.raises(ValueError):
+        study.aggregate_dataframes(table_format='xlsx')
+
+
+def test_aggregate_dataframes_parquet(tmp_path):
+    pytest.importorskip('pyarrow')
+
+    folder = _setup_synthetic_study(tmp_path / 'parquet_study')
+    study = GroundTruthStudy(folder)
+    study.run_comparisons(exhaustive_gt=True)
+    dataframes = study.aggregate_dataframes(table_format='parquet')
+
+    for name, df in dataframes.items():
+        df_read = pd.read_parquet(folder / 'tables' / (name + '.parquet'))
+        pd.testing.assert_frame_equal(df.reset_index(drop=True), df_read)
+
+
+def test_lazy_scan_and_sortings_cache(tmp_path, monkeypatch):
+    folder = _setup_synthetic_study(tmp_path / 'lazy_study')
+
+    loaded = []
+
+    class CountingNpzSortingExtractor(se.NpzSortingExtractor):
+        def __init__(self, *args, **kwargs):
+            loaded.append(1)
+            se.NpzSortingExtractor.__init__(self, *args, **kwargs)
+
+    monkeypatch.setattr(se, 'NpzSortingExtractor', CountingNpzSortingExtractor)
+
+    study = GroundTruthStudy(folder)
+    assert not study._is_scanned
+    assert study.rec_names == ['rec0', 'rec1']
+    assert study._is_scanned
+    assert study.sorter_names == ['sorterA', 'sorterB']
+
+    # every sorting is read once for the whole workflow
+    study = GroundTruthStudy(folder)
+    study.run_comparisons(exhaustive_gt=True, cache_comparisons=False)
+    study.aggregate_dataframes(copy_into_folder=False)
+    assert len(loaded) == 4
+
+
+def test_cached_and_uncached_results(tmp_path):
+    folder = _setup_synthetic_study(tmp_path / 'compare_study')
+
+    results = []
+    for cache_sortings, n_jobs_comparisons in [(True, 1), (False, 1), (True, 2)]:
+        study = GroundTruthStudy(folder, cache_sortings=cache_sortings)
+        study.run_comparisons(exhaustive_gt=True, n_jobs_comparisons=n_jobs_comparisons, cache_comparisons=False)
+        results.append((study.aggregate_performance_by_units(), study.aggregate_count_units()))
+
+    perf_ref, count_ref = results[0]
+    for perf, count in results[1:]:
+        pd.testing.assert_frame_equal(perf.sort_index(), perf_ref.sort_index())
+        pd.testing.assert_frame_equal(count.sort_index(), count_ref.sort_index())
+
+    assert count_ref.loc[('rec0', 'sorterA'), 'num_gt'] == 5
+    assert count_ref.loc[('rec0', 'sorterA'), 'num_sorter'] == 5
+
+
+def test_return_indexed(tmp_path):
+    folder = _setup_synthetic_study(tmp_path / 'indexed_study')
+    study = GroundTruthStudy(folder)
+    study.run_comparisons(exhaustive_gt=True, cache_comparisons=False)
+
+    perf = study.aggregate_performance_by_units()
+    assert list(perf.index.names) == ['rec_name', 'sorter_name', 'gt_unit_id']
+    flat = study.aggregate_performance_by_units(return_indexed=False)
+    assert list(flat.columns[:3]) == ['rec_name', 'sorter_name', 'gt_unit_id']
+    pd.testing.assert_frame_equal(flat.set_index(['rec_name', 'sorter_name', 'gt_unit_id']), perf)
+    assert not isinstance(flat['rec_name'].dtype, pd.CategoricalDtype)
+
+    dataframes = study.aggregate_dataframes(copy_into_folder=False)
+    pd.testing.assert_frame_equal(dataframes['perf_by_units'], flat)
+    pd.testing.assert_frame_equal(dataframes['count_units'], study.aggregate_count_units().reset_index())
+
+
+def test_units_snr_memory_cache(tmp_path):
+    folder = _setup_synthetic_study(tmp_path / 'snr_study')
+    (folder / 'metrics').mkdir()
+    snr_filename = folder / 'metrics' / 'SNR rec0.txt'
+    snr_file = pd.DataFrame({'gt_unit_id': np.arange(5), 'snr': np.linspace(2., 10., 5)})
+    snr_file.to_csv(snr_filename, sep='\t', index=False)
+
+    study = GroundTruthStudy(folder)
+    snr = study.get_units_snr(rec_name='rec0')
+    assert np.allclose(snr['snr'].values, snr_file['snr'].values)
+
+    # second call does not read the file and callers can not alter the cache
+    os.remove(str(snr_filename))
+    snr.loc[0, 'snr'] = -1.
+    snr2 = study.get_units_snr(rec_name='rec0')
+    assert np.allclose(snr2['snr'].values, snr_file['snr'].values)
+
+
 if __name__ == '__main__':
     # ~ setup_module()
     test_extract_sortings()